@@ -15,9 +15,11 @@ import cf # available from https://ncas-cms.github.io/cf-python/
 import os,os.path,fnmatch
 import numpy
 from collections.abc import Sequence
-from scipy.stats import norm
+from collections import namedtuple
+from scipy.special import ndtri
 import gc
 import dask.array as da
+import multiprocessing,io,contextlib
 
 # First year of AR5 projections
 endofhistory=2006
@@ -38,9 +40,35 @@ dant=(2.37+0.13)*1e-3
 # Conversion factor for Gt to m SLE
 mSLEoGt=1e12/3.61e14*1e-3
 
+# Parameters of the glacier methods used by project_glacier, for each value of
+# its glaciermip argument: False => AR5, 1 => fit to GlacierMIP (Hock et al.,
+# 2019), 2 => fit to GlacierMIP2 (Marzeion et al., 2020). For each method,
+# factor and exponent are the parameters of the AR5 formula, and cvgl is the
+# coefficient of variation of the random methodological error. They are held
+# as arrays with one element per method so that the methods can be evaluated
+# together.
+glparm={
+  False:dict(name=['Marzeion','Radic','Slangen','Giesen'],
+    factor=numpy.array([4.96,5.45,3.44,3.02]),
+    exponent=numpy.array([0.685,0.676,0.742,0.733]),
+    cvgl=numpy.full(4,0.20)), # the same for all AR5 methods
+  1:dict(name=['SLA2012','MAR2012','GIE2013','RAD2014','GloGEM'],
+    factor=numpy.array([3.39,4.35,3.57,6.21,2.88]),
+    exponent=numpy.array([0.722,0.658,0.665,0.648,0.753]),
+    cvgl=numpy.array([0.15,0.13,0.13,0.17,0.13])),
+  2:dict(name=['GLIMB','GloGEM','JULES','Mar-12','OGGM','RAD2014','WAL2001'],
+    factor=numpy.array([3.70,4.08,5.50,4.89,4.26,5.18,2.66]),
+    exponent=numpy.array([0.662,0.716,0.564,0.651,0.715,0.709,0.730]),
+    cvgl=numpy.array([0.206,0.161,0.188,0.141,0.164,0.135,0.206]))}
+
 class ProjectionError(Exception):
   pass
 
+# Sizes of the dimensions [component_realization,climate_realization] of the
+# projected quantities, and the years of their time coordinate, obtained once
+# for each scenario and passed to the functions which make the projections
+Shape=namedtuple('Shape','nm nt year')
+
 def vlikely_range(data):
 # Compute median and 5-95% range for the first (or only) axis of data.
 # Return array (stat[,dom1,...]), where stat=0,1,2 for 50-,5-,95-percentile,
@@ -60,10 +88,11 @@ def actual_range(data):
     numpy.amax(data,0)])
 
 def report(quantity,field=None,output=None,prefix=None,ensemble=False,
-  uniform=False,nr=None):
+  uniform=False,nr=None,statistics=None,listpath=None):
 # Report the likely range of a projected quantity in the last timestep and
-# optionally save the timeseries of likely range and median, and the
-# individual realisations of the ensemble, as CF-netCDF files.
+# optionally save the timeseries of likely range and median, in one field
+# with a statistic dimension, and the individual realisations of the ensemble,
+# as CF-netCDF files.
 # quantity -- str, printed name of quantity, used also to name output files.
 #   If field is omitted, quantity is the name of the scenario.
 # field -- cf.Field, optional, containing the data of the quantity, assumed to
@@ -83,12 +112,18 @@ def report(quantity,field=None,output=None,prefix=None,ensemble=False,
 #   as the assessed *likely* range for the true answer)
 # nr -- int, optional, indicates that each realisation on input should be
 #   replicated nr times on output to file
+# statistics -- list, optional, to which the field of the timeseries of likely
+#   range and median is appended, to be written later, instead of being written
+#   to its own file
+# listpath -- str, optional, path of the list file, by default the file named
+#   list in the output directory
 
 ##  print("free memory:", cf.free_memory() / 1e9, "GB")
   if not field:
     print(quantity)
     if output:
-      listfile=open(output+'/list','a')
+      if listpath is None: listpath=output+'/list'
+      listfile=open(listpath,'a')
       listfile.write(quantity+'\n')
       listfile.close()
     return
@@ -107,20 +142,22 @@ def report(quantity,field=None,output=None,prefix=None,ensemble=False,
 # Optionally write output files
   nyr=field.axis('T').size ## duplicate
   if output:
-    listfile=os.path.dirname(output)+'/list'
+    if listpath is None: listpath=os.path.dirname(output)+'/list'
     if prefix: listline=prefix+listline
-    listfile=open(listfile,'a')
+    listfile=open(listpath,'a')
     listfile.write(listline+'\n')
     listfile.close()
 
-# Reshape data as two-dimensional with time as the second dimension
-    nyr=field.axis('T').size
+# Reshape data as two-dimensional with time as the second dimension. The
+# fields of projections are constructed with time as the last dimension, in
+# which case no transpose is needed and the reshape does not copy.
     timeaxis=field.axis('T',key=True)
-    axes=list(field.constructs.filter_by_type('domain_axis',todict='True'))
-    axes=[axis for axis in axes if axis!=timeaxis]
-    axes.append(timeaxis)
-    field.transpose(axes,inplace=True)
-    data=field.array.reshape(field.size//nyr,nyr)
+    axes=list(field.get_data_axes())
+    if axes[-1]!=timeaxis:
+      axes.remove(timeaxis)
+      axes.append(timeaxis)
+      field.transpose(axes,inplace=True)
+    data=field.array.reshape(-1,nyr)
 # 2D datarange with time as the second dimension
     if uniform: datarange=actual_range(data)
     else: datarange=vlikely_range(data)
@@ -147,18 +184,28 @@ def report(quantity,field=None,output=None,prefix=None,ensemble=False,
         landwater="decrease of land water storage",
         sheetdyn="decrease of ice sheet mass due to rapid dynamical change")\
         [quantity]
-    statfield.set_construct(field.axis('T'))
-    statfield.set_construct(field.dim('T'))
+# The three statistics are written to a single file with a statistic dimension
+# whose auxiliary coordinate labels them as mid, lower and upper
+    axisstat=cf.DomainAxis(3)
+    axisstat.nc_set_dimension('nstatistic')
+    axisstat=statfield.set_construct(axisstat)
+    axistime=statfield.set_construct(field.axis('T'))
+    statfield.set_construct(field.dim('T'),axes=axistime)
+    stataux=cf.AuxiliaryCoordinate(data=cf.Data(['mid','lower','upper']),
+      properties=dict(long_name='statistic'))
+    stataux.nc_set_variable('statistic')
+    statfield.set_construct(stataux,axes=axisstat)
     if quantity=="temperature": statfield.unit='K'
     else: statfield.unit='m'
     statfield.nc_set_variable(quantity)
-    statfield.set_data(cf.Data(numpy.empty(nyr)))
-    stats=dict(mid=0,lower=1,upper=2)
-    for stat in stats:
-      statfield.data[:]=datarange[stats[stat],:]
-      cf.write(statfield,output+quantity+"_"+stat+".nc")
-
-  if output:
+    statfield.set_data(cf.Data(datarange),axes=[axisstat,axistime])
+    if statistics is None: cf.write(statfield,output+quantity+"_stats.nc")
+    else: statistics.append(statfield)
+
+# The ensemble field is constructed only if it is to be written. Its data are
+# replicated lazily, in blocks of realisations, so that the whole ensemble is
+# not held in memory at once.
+  if output and ensemble:
     if field.domain_axes('realization'): ofield=field
     else:
       nt=field.axis('climate_realization').size
@@ -166,7 +213,8 @@ def report(quantity,field=None,output=None,prefix=None,ensemble=False,
       data = data.astype('float32')
       data = data.reshape(-1, nyr)
       if nr:
-        data = da.broadcast_to(data, (nr, nt, nyr),chunks=(nr // 10, -1, -1))
+        data = da.broadcast_to(data, (nr, nt, nyr),
+          chunks=(max(nr // 10, 1), -1, -1))
         data = data.reshape(nr * nt, nyr)
       else:
         nr=data.shape[0]//nt
@@ -180,9 +228,7 @@ def report(quantity,field=None,output=None,prefix=None,ensemble=False,
         properties=dict(standard_name="realization"))
       ofield.set_construct(realdim)
       climaux=cf.AuxiliaryCoordinate(
-        data=cf.Data(da.broadcast_to(
-        da.arange(nt, dtype="int32"), (nr, nt), chunks=(nr // 10, -1)
-        ).reshape(nr * nt)),
+        data=cf.Data(numpy.tile(numpy.arange(nt, dtype="int32"), nr)),
         properties=dict(long_name='climate_realization'))
       climaux.nc_set_variable('climate')
       ofield.set_construct(climaux)
@@ -191,12 +237,44 @@ def report(quantity,field=None,output=None,prefix=None,ensemble=False,
       else:
         ofield.long_name=statfield.long_name
       ofield.unit=statfield.unit
+# Store the file in chunks of whole timeseries for consecutive realisations,
+# of about 4 MiB each, rather than the library default of small chunks
+      chunkbytes=4*1024**2
+      nrchunk=max(1,min(ofield.shape[0],chunkbytes//(nyr*data.dtype.itemsize)))
+      ofield.data.nc_set_dataset_chunksizes([nrchunk,nyr])
     ofield.nc_set_variable(quantity)
-    if ensemble: cf.write(ofield,output+quantity+".nc")
+    cf.write(ofield,output+quantity+".nc")
 
   return(field)
 
-def project(input=None,scenarios=None,output=None,levermann=None,**kwargs):
+class ScenarioReport:
+# Report the quantities projected for one scenario with report(), collecting
+# the fields of their timeseries of likely range and median so that flush()
+# writes them all to the single CF-netCDF file OUTPUTstats.nc. One file per
+# scenario is much quicker to write than one for each quantity.
+# output, prefix, ensemble, listpath -- as for report()
+
+  def __init__(self,output=None,prefix=None,ensemble=False,listpath=None):
+    self.output=output
+    self.prefix=prefix
+    self.ensemble=ensemble
+    self.listpath=listpath
+    self.statistics=[]
+
+  def add(self,quantity,field,**kwargs):
+# Report a quantity and collect its statistics, returning the field as report()
+# does. Any other keyword arguments are passed to report().
+    return report(quantity,field,self.output,self.prefix,self.ensemble,
+      statistics=self.statistics,listpath=self.listpath,**kwargs)
+
+  def flush(self):
+# Write the statistics collected so far, if there is an output file
+    if self.output and self.statistics:
+      cf.write(self.statistics,self.output+"stats.nc")
+    self.statistics=[]
+
+def project(input=None,scenarios=None,output=None,levermann=None,processes=1,
+  **kwargs):
 # input -- str, path to directory containing input files. The directory should
 #   contain files named SCENARIO_QUANTITY_STATISTIC.nc, where QUANTITY is
 #   temperature or expansion, and STATISTIC is mean, sd or models. Each file
@@ -210,7 +288,7 @@ def project(input=None,scenarios=None,output=None,levermann=None,**kwargs):
 #   argument is omitted.
 # ensemble -- bool, optional, default False, write output files of the ensemble
 #   as well as the statistics.
-# seed -- optional, for numpy.random, default zero
+# seed -- optional, for the numpy.random.Generator, default zero
 # nt -- int, optional, number of realisations of the input timeseries for each
 #   scenario, default 450, to be generated using the mean and sd files; specify
 #   0 if the ensemble of individual models is to be used instead, which is read
@@ -231,6 +309,12 @@ def project(input=None,scenarios=None,output=None,levermann=None,**kwargs):
 # palmer -- bool, optional, default False, allow integration to end in any year
 #   up to 2300, with the contributions to GMLSR from ice-sheet dynamics, Green-
 #   land SMB and land water storage held at the 2100 rate beyond 2100.
+# processes -- int, optional, default 1, maximum number of scenarios to be
+#   projected at the same time in separate processes. The output is the same
+#   as when they are done one after another, but each process needs as much
+#   memory as a single scenario. The processes are spawned rather than forked,
+#   because a forked process can deadlock if cf-python has already been used,
+#   so the calling script must be protected by if __name__=='__main__'.
 
 # Check input directory
   if input is None:
@@ -242,11 +326,12 @@ def project(input=None,scenarios=None,output=None,levermann=None,**kwargs):
 ##  if output is None:
 ##    raise ProjectionError('output directory must be specified')
 
+# Find the input files once for all scenarios
+  files=input_files(input)
+
   if scenarios is None:
 # Obtain list of scenarios from the input filenames
-    bname=fnmatch.filter(os.listdir(input),'*_*.nc')
-    scenarios=[tname.split('_',1)[0] for tname in bname]
-    scenarios=sorted(set(scenarios))
+    scenarios=sorted(files)
   elif isinstance(scenarios,str):
     scenarios=[scenarios]
   else:
@@ -273,26 +358,90 @@ def project(input=None,scenarios=None,output=None,levermann=None,**kwargs):
       raise ProjectionError('output directory not writable: '+output)
     elif os.access(output+'/list',os.F_OK): os.unlink(output+'/list')
 
+  if processes>1 and len(scenarios)>1:
+# The scenarios are independent, so they are projected in parallel. Their
+# stdout and list files are combined in the order of the scenarios. The list
+# files of the scenarios are removed even if a process fails.
+    arguments=[(input,scenario,output,levermann[scenario],
+      dict(kwargs,files=files.get(scenario,{}))) for scenario in scenarios]
+    context=multiprocessing.get_context('spawn')
+    try:
+      with context.Pool(min(processes,len(scenarios))) as pool:
+        for scenario,stdout in \
+          zip(scenarios,pool.imap(project_scenario_worker,arguments)):
+          report(scenario+':',output=output)
+          print(stdout,end='')
+          if output:
+            scenariolist=output+'/'+scenario+'_list'
+            with open(scenariolist) as listfile: lines=listfile.read()
+            with open(output+'/list','a') as listfile: listfile.write(lines)
+            os.unlink(scenariolist)
+    finally:
+      if output:
+        for scenario in scenarios:
+          scenariolist=output+'/'+scenario+'_list'
+          if os.access(scenariolist,os.F_OK): os.unlink(scenariolist)
+    return
+
   for scenario in scenarios:
     report(scenario+':',output=output)
     project_scenario(input,scenario,output,\
-      levermann=levermann[scenario],**kwargs)
+      levermann=levermann[scenario],files=files.get(scenario,{}),**kwargs)
     gc.collect()
 
+def input_files(input):
+# Return a dict of the input files in a directory, whose keys are scenarios and
+# whose values are dicts, with keys QUANTITY_STATISTIC, of the paths of files
+# named SCENARIO_QUANTITY_STATISTIC.nc. The name is split from the right,
+# because SCENARIO may contain underscores but QUANTITY and STATISTIC do not.
+# input -- str, path to directory containing input files
+  files={}
+  with os.scandir(input) as entries:
+    for entry in entries:
+      if entry.is_file() and fnmatch.fnmatch(entry.name,'*_*_*.nc'):
+        scenario,quant,stat=entry.name[:-len('.nc')].rsplit('_',2)
+        if scenario:
+          files.setdefault(scenario,{})[quant+'_'+stat]=entry.path
+  return files
+
+def project_scenario_worker(arguments):
+# Make GMSLR projection for a single scenario in a separate process for
+# project(), returning what is printed on stdout as a str. The lines for the
+# list file are written to SCENARIO_list in the output directory, for project()
+# to append to the list file in the order of the scenarios.
+# arguments -- tuple of input, scenario, output, levermann and a dict of the
+#   other keyword arguments of project_scenario()
+  input,scenario,output,levermann,kwargs=arguments
+  listpath=None
+  if output:
+    listpath=output+'/'+scenario+'_list'
+    if os.access(listpath,os.F_OK): os.unlink(listpath)
+  stdout=io.StringIO()
+  with contextlib.redirect_stdout(stdout):
+    project_scenario(input,scenario,output,levermann=levermann,
+      listpath=listpath,**kwargs)
+  return stdout.getvalue()
+
 def project_scenario(input,scenario,output=None,\
   seed=0,nt=450,nm=1000,tcv=1.0,\
-  glaciermip=False,ensemble=False,levermann=False,palmer=False):
+  glaciermip=False,ensemble=False,levermann=False,palmer=False,files=None,
+  listpath=None):
 # Make GMSLR projection for the specified single scenario
 # Arguments are all the same as project() except for:
 # scenario -- str, name of the scenario
 # levermann -- optional, treated as True/False to specify that Levermann
 #   should be used, if str it identifies the Leverman scenario fit to be used,
 #   otherwise assumed to be the scenario being simulated
+# files -- dict, optional, the input files for the scenario, as returned for
+#   it by input_files(); by default they are found in the input directory
+# listpath -- str, optional, path of the list file, by default the file named
+#   list in the output directory
 
   if not isinstance(scenario,str):
     raise ProjectionError('scenario must be a single string')
 
-  numpy.random.seed(seed)
+# All the random numbers are obtained from this generator
+  rng=numpy.random.default_rng(seed)
 
   startyr=endofhistory # year when the timeseries for integration begin
   if palmer: maxyr=2300
@@ -316,14 +465,18 @@ def project_scenario(input,scenario,output=None,\
   else:
     statin=['mean','sd'] # input statistics
     ndim=1
+  input=os.path.expandvars(os.path.expanduser(input))
+  if files is None:
+    if os.path.isdir(input): files=input_files(input).get(scenario,{})
+    else: files={}
   txin=[]
   for quant in quantin:
     for stat in statin:
       key=quant+'_'+stat
-      file=input+'/'+scenario+'_'+key+'.nc'
-      file=os.path.expandvars(os.path.expanduser(file))
-      if not os.path.isfile(file):
-        raise ProjectionError('missing input file: '+file)
+      if key not in files:
+        raise ProjectionError('missing input file: '+\
+          input+'/'+scenario+'_'+key+'.nc')
+      file=files[key]
       field=cf.read(file)[0]
       if field.ndim!=ndim:
         raise ProjectionError('field is not '+str(ndim)+\
@@ -332,7 +485,7 @@ def project_scenario(input,scenario,output=None,\
         raise ProjectionError('field does not have a time axis in file '+file)
       if ndim==2 and field.axis('ncdim%model',None) is None:
         raise ProjectionError('field does not have a model axis in file '+file)
-      if field.mask.any():
+      if numpy.ma.is_masked(field.array):
         raise ProjectionError('missing data is not allowed in file '+file)
       field.override_units('1',inplace=True)
       txin.append(field)
@@ -368,8 +521,12 @@ def project_scenario(input,scenario,output=None,\
   itin=[txin[0].copy()]
   if nt>0: itin.append(txin[1].copy())
   for field in itin:
-#    field.data=cf.Data(numpy.cumsum(field.data,axis=-1))
-    field.cumsum('T',inplace=True)
+# numpy.cumsum in place on the array, which is small, avoids the overheads of
+# cf.Field.cumsum
+    axes=field.get_data_axes()
+    data=field.array
+    numpy.cumsum(data,axis=axes.index(field.axis('T',key=True)),out=data)
+    field.set_data(cf.Data(data,units=field.Units),axes=axes)
     field.del_construct('T')
     field.set_construct(txin[-1].dim('T'))
 
@@ -397,183 +554,198 @@ def project_scenario(input,scenario,output=None,\
       data=cf.Data(da.arange(nt)),
       properties=dict(standard_name='climate_realization'))
     z.set_construct(climdim)
-    z.set_data(cf.Data(numpy.random.standard_normal(nt)*tcv))
+    z.set_data(cf.Data(rng.standard_normal(nt)*tcv))
 # For each quantity, mean + standard deviation * normal random number
     zt=z*txin[1]+txin[0]
     zx=z*txin[3]+txin[2]
     zit=z*itin[1]+itin[0]
     zitmean=itin[0]
 
-# Create a cf.Field with the shape of the quantities to be calculated
-# [component_realization,climate_realization,time]
+# Ensure that the ensembles are [climate_realization,time], as assumed when
+# their data are used in the projections of the components
+  for field in [zt,zx,zit]:
+    field.transpose(['climate_realization','T'],inplace=True)
+
+# Create a cf.Field with the domain of the quantities to be calculated
+# [component_realization,climate_realization,time]. It has no data, because
+# ensemble_field() supplies the data of each quantity.
   template=cf.Field()
   template.set_construct(cf.DomainAxis(nm),'axiscomp')
   template.set_construct(cf.DomainAxis(nt),'axisclim')
   template.set_construct(cf.DomainAxis(nyr),'axistime')
-  template.set_data(cf.Data(numpy.full([nm,nt,nyr],numpy.nan)),
-    axes=['axiscomp','axisclim','axistime'])
   template.units='1'
   template.set_construct(txin[-1].dim('T'))
   template.set_construct(climdim,'dimclim')
   compdim=cf.DimensionCoordinate(data=cf.Data(numpy.arange(nm)),\
     properties=dict(standard_name='component_realization'))
   template.set_construct(compdim,'dimcomp')
+  shape=Shape(nm,nt,time.year.array)
 
-# Obtain ensembles of projected components as cf.Field objects and add them up
+# Obtain ensembles of projected components and add them up
 # Report the range of the final year and write output files if requested
   if output:
     output=output+"/"+scenario+"_"
     prefix="%-10s "%scenario
   else: prefix=''
+  reports=ScenarioReport(output,prefix,ensemble,listpath)
 
   temperature=zt
-  report("temperature",temperature,output,prefix,ensemble,nr=nm)
+  reports.add("temperature",temperature,nr=nm)
 
   expansion=zx
-  expansion=report("expansion",expansion,output,prefix,ensemble,nr=nm)
-
-  glacier=project_glacier(zitmean,zit,template,glaciermip)
-  glacier=report("glacier",glacier,output,prefix,ensemble)
-
-  greensmb=project_greensmb(zt,template,palmer)
-  greensmb=report("greensmb",greensmb,output,prefix,ensemble)
-
-  fraction=numpy.random.rand(nm*nt) # correlation between antsmb and antdyn
-  antsmb=project_antsmb(zit,template,fraction)
-  antsmb=report("antsmb",antsmb,output,prefix,ensemble)
-
-  greendyn=project_greendyn(scenario,template,palmer)
-  greendyn=report("greendyn",greendyn,output,prefix,ensemble,uniform=True)
+  expansion=reports.add("expansion",expansion,nr=nm)
+
+# The projected components are numpy arrays [component_realization,
+# climate_realization,time], which are put into cf.Field objects only for
+# reporting
+  expansion=expansion.array
+  zitarray=zit.array
+  glacier=project_glacier(zitmean.array,zitarray,shape,rng,glaciermip)
+  reports.add("glacier",ensemble_field(template,glacier))
+
+  greensmb=project_greensmb(zt,shape,rng,palmer)
+  reports.add("greensmb",ensemble_field(template,greensmb))
+
+  fraction=rng.random(nm*nt) # correlation between antsmb and antdyn
+  antsmb=project_antsmb(zitarray,shape,rng,fraction)
+  del(zitarray)
+  reports.add("antsmb",ensemble_field(template,antsmb))
+
+  greendyn=project_greendyn(scenario,shape,rng,palmer)
+  reports.add("greendyn",ensemble_field(template,greendyn),uniform=True)
   greennet=greensmb+greendyn
   del(greensmb)
 
   if levermann and not isinstance(levermann,str): levermann=scenario
-  antdyn=project_antdyn(template,fraction,levermann,output,palmer)
+  antdyn=project_antdyn(shape,rng,fraction,levermann,output,palmer)
   del(fraction)
-  antdyn=report("antdyn",antdyn,output,prefix,ensemble,uniform=not levermann)
+  reports.add("antdyn",ensemble_field(template,antdyn),uniform=not levermann)
   antnet=antsmb+antdyn
   del(antsmb)
 
-  landwater=project_landwater(template,palmer)
-  landwater=report("landwater",landwater,output,prefix,ensemble,uniform=True)
+  landwater=project_landwater(shape,rng,palmer)
+  reports.add("landwater",ensemble_field(template,landwater),uniform=True)
 
-# add expansion last because it has a lower dimensionality and we want it to
-# be broadcast to the same shape as the others rather than messing up gmslr
+# expansion is [climate_realization,time] and is broadcast to the shape of the
+# others
   gmslr=glacier+greennet+antnet+landwater+expansion
-  report("GMSLR",gmslr,output,prefix,ensemble)
+  reports.add("GMSLR",ensemble_field(template,gmslr))
+  del(gmslr)
 
-  report("greennet",greennet,output,prefix,ensemble)
-  report("antnet",antnet,output,prefix,ensemble)
+  reports.add("greennet",ensemble_field(template,greennet))
+  reports.add("antnet",ensemble_field(template,antnet))
   sheetdyn=greendyn+antdyn
-  report("sheetdyn",sheetdyn,output,prefix,ensemble)
+  reports.add("sheetdyn",ensemble_field(template,sheetdyn))
+
+  reports.flush()
 
   return
 
-def project_glacier(it,zit,template,glaciermip):
-# Return projection of glacier contribution as a cf.Field
-# it -- cf.Field, time-integral of median temperature anomaly timeseries
-# zit -- cf.Field, ensemble of time-integral temperature anomaly timeseries
-# template -- cf.Field with the required shape of the output
+def ensemble_field(template,data):
+# Return a cf.Field with the metadata of template containing the given data
+# template -- cf.Field without data, with the required domain of the output
+# data -- numpy.ndarray [component_realization,climate_realization,time]
+  field=template.copy()
+  field.set_data(cf.Data(data,units=template.Units),
+    axes=['axiscomp','axisclim','axistime'])
+  return field
+
+def project_glacier(it,zit,shape,rng,glaciermip):
+# Return projection of glacier contribution as a numpy.ndarray
+# it -- numpy.ndarray [time], time-integral of median temperature anomaly
+#   timeseries
+# zit -- numpy.ndarray [climate_realization,time], ensemble of time-integral
+#   temperature anomaly timeseries
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 # glaciermip -- False => AR5 parameters, 1 => fit to Hock et al. (2019),
 #   2 => fit to Marzeion et al. (2020)
 
-  startyr=int(template.dim('T').year.data[0])-1
+  startyr=int(shape.year[0])-1
 
   dmzdtref=0.95 # mm yr-1 in Marzeion's CMIP5 ensemble mean for AR5 ref period
   dmz=dmzdtref*(startyr-1996)*1e-3 # m from glacier at start wrt AR5 ref period
   glmass=412.0-96.3 # initial glacier mass, used to set a limit, from Tab 4.2
   glmass=1e-3*glmass # m SLE
 
-  nr=template.axis('axiscomp').size
-  if glaciermip:
-    if glaciermip==1:
-      glparm=[dict(name='SLA2012',factor=3.39,exponent=0.722,cvgl=0.15),\
-        dict(name='MAR2012',factor=4.35,exponent=0.658,cvgl=0.13),\
-        dict(name='GIE2013',factor=3.57,exponent=0.665,cvgl=0.13),\
-        dict(name='RAD2014',factor=6.21,exponent=0.648,cvgl=0.17),\
-        dict(name='GloGEM',factor=2.88,exponent=0.753,cvgl=0.13)]
-      cvgl=0.15 # unnecessary default
-    elif glaciermip==2:
-      glparm=[dict(name='GLIMB',factor=3.70,exponent=0.662,cvgl=0.206),\
-        dict(name='GloGEM',factor=4.08,exponent=0.716,cvgl=0.161),\
-        dict(name='JULES',factor=5.50,exponent=0.564,cvgl=0.188),\
-        dict(name='Mar-12',factor=4.89,exponent=0.651,cvgl=0.141),\
-        dict(name='OGGM',factor=4.26,exponent=0.715,cvgl=0.164),\
-        dict(name='RAD2014',factor=5.18,exponent=0.709,cvgl=0.135),\
-        dict(name='WAL2001',factor=2.66,exponent=0.730,cvgl=0.206)]
-      cvgl=0.20 # unnecessary default
-    else: raise ProjectionError('unknown GlacierMIP version: '+str(glaciermip))
-  else:
-    glparm=[dict(name='Marzeion',factor=4.96,exponent=0.685),\
-      dict(name='Radic',factor=5.45,exponent=0.676),\
-      dict(name='Slangen',factor=3.44,exponent=0.742),\
-      dict(name='Giesen',factor=3.02,exponent=0.733)]
-    cvgl=0.20 # random methodological error
-  ngl=len(glparm) # number of glacier methods
+  nr=shape.nm
+  if not glaciermip: glaciermip=False
+  if glaciermip not in glparm:
+    raise ProjectionError('unknown GlacierMIP version: '+str(glaciermip))
+  factor=glparm[glaciermip]['factor']
+  exponent=glparm[glaciermip]['exponent']
+  cvgl=glparm[glaciermip]['cvgl']
+  ngl=factor.size # number of glacier methods
   if nr%ngl:
     raise ProjectionError('number of realisations '+\
       'must be a multiple of number of glacier methods')
   nrpergl=int(nr/ngl) # number of realisations per glacier method
-  r=cf.Field()
-  r.set_construct(template.axis('axiscomp'))
-  r.set_construct(template.dim('dimcomp'))
-  r.set_data(cf.Data(numpy.random.standard_normal(nr)))
-  r.set_property('units','1')
-
-# Make an ensemble of projections for each method
-  glacier=template.copy()
-  for igl in range(ngl):
-# glacier projection for this method using the median temperature timeseries
-    mgl=project_glacier1(it,glparm[igl]['factor'],glparm[igl]['exponent'])
-# glacier projections for this method with the ensemble of timeseries
-    zgl=project_glacier1(zit,glparm[igl]['factor'],glparm[igl]['exponent'])
-    ifirst=igl*nrpergl
-    ilast=ifirst+nrpergl
-    if glaciermip: cvgl=glparm[igl]['cvgl']
-    glacier[ifirst:ilast,...]=zgl+mgl*r[ifirst:ilast]*cvgl
+  r=rng.standard_normal(nr)
+
+# Make an ensemble of projections for all methods at once, the realisations
+# for each method being consecutive
+# glacier projections for each method using the median temperature timeseries
+  mgl=project_glacier1(it,factor,exponent) # [method,time]
+# glacier projections for each method with the ensemble of timeseries
+  zgl=project_glacier1(zit,factor,exponent) # [method,climate,time]
+# random methodological error [method,realisation]
+  rgl=r.reshape(ngl,nrpergl)*cvgl[:,numpy.newaxis]
+  glacier=zgl[:,numpy.newaxis,:,:]+\
+    mgl[:,numpy.newaxis,numpy.newaxis,:]*\
+    rgl[:,:,numpy.newaxis,numpy.newaxis]
+  del(zgl)
+  glacier.shape=(nr,)+zit.shape
 
   glacier+=dmz
-  glacier.where(glacier>glmass,glmass,inplace=True)
-  glacier.persist(inplace=True)
+  numpy.minimum(glacier,glmass,out=glacier)
 
   return glacier
 
 def project_glacier1(it,factor,exponent):
-# Return projection of glacier contribution by one glacier method
+# Return projection of glacier contribution by one or more glacier methods
+# it -- numpy.ndarray, time-integral temperature anomaly
+# factor, exponent -- float or numpy.ndarray [method], parameters of the
+#   glacier methods; if arrays, the result has a leading dimension of method
   scale=1e-3 # mm to m
-  return scale*factor*(it.where(it<0,0)**exponent)
+  factor=numpy.asarray(factor)
+  shape=factor.shape+(1,)*it.ndim # broadcast method against it
+  glacier=numpy.maximum(it,0)**numpy.reshape(exponent,shape)
+  glacier*=scale*factor.reshape(shape) # in place, avoiding a temporary
+  return glacier
 
-def project_greensmb(zt,template,palmer=False):
-# Return projection of Greenland SMB contribution as a cf.Field
-# zt -- cf.Field, ensemble of temperature anomaly timeseries
-# template -- cf.Field with the required shape of the output
+def project_greensmb(zt,shape,rng,palmer=False):
+# Return projection of Greenland SMB contribution as a numpy.ndarray
+# zt -- cf.Field [climate_realization,time], ensemble of temperature anomaly
+#   timeseries
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 
   dtgreen=-0.146 # Delta_T of Greenland ref period wrt AR5 ref period  
   fnlogsd=0.4 # random methodological error of the log factor
   febound=[1,1.15] # bounds of uniform pdf of SMB elevation feedback factor
 
-  nr=template.axis('axiscomp').size
+  nr=shape.nm
 # random log-normal factor
-  fn=numpy.exp(numpy.random.standard_normal(nr)*fnlogsd)
+  fn=numpy.exp(rng.standard_normal(nr)*fnlogsd)
 # elevation feedback factor
-  fe=numpy.random.sample(nr)*(febound[1]-febound[0])+febound[0]
-  ff=cf.Field()
-  ff.set_construct(template.axis('axiscomp'))
-  ff.set_construct(template.dim('dimcomp'))
-  ff.set_data(cf.Data(fn*fe))
-  
-  ztgreen=zt-dtgreen
-  greensmbrate=ff*fettweis(ztgreen)
-  del(ff)
-
-  if palmer and greensmbrate.construct('T').year.max()>endofAR5:
-    indices=greensmbrate.indices(T=cf.year(cf.gt(endofAR5)))
-    greensmbrate[indices]=greensmbrate.subspace(T=cf.year(endofAR5))
-
-  greensmb=greensmbrate.cumsum('T')
-  del(greensmbrate)
-  greensmb.del_construct('T')
-  greensmb.set_construct(template.dim('T'))
+  fe=rng.random(nr)*(febound[1]-febound[0])+febound[0]
+  ff=fn*fe
+
+# The random factor is constant in time, so the rate can be integrated before
+# it is applied. This is done for the ensemble of temperature timeseries
+# [climate_realization,time], which is much smaller than the output.
+  ztgreen=zt.array-dtgreen
+  greensmbrate=fettweis(ztgreen)
+  del(ztgreen)
+
+  if palmer:
+    year=zt.dim('T').year.array
+    if year.max()>endofAR5:
+      greensmbrate[...,year>endofAR5]=greensmbrate[...,year==endofAR5]
+
+  numpy.cumsum(greensmbrate,axis=-1,out=greensmbrate)
+  greensmb=ff[:,numpy.newaxis,numpy.newaxis]*greensmbrate[numpy.newaxis,:,:]
+  del(ff,greensmbrate)
   greensmb+=(1-fgreendyn)*dgreen
 
   return greensmb
@@ -581,31 +753,42 @@ def project_greensmb(zt,template,palmer=False):
 def fettweis(ztgreen):
 # Greenland SMB in m yr-1 SLE from global mean temperature anomaly
 # using Eq 2 of Fettweis et al. (2013)
-  return (71.5*ztgreen+20.4*(ztgreen**2)+2.8*(ztgreen**3))*mSLEoGt
-
-def project_antsmb(zit,template,fraction=None):
-# Return projection of Antarctic SMB contribution as a cf.Field
-# zit -- cf.Field, ensemble of time-integral temperature anomaly timeseries
-# template -- cf.Field with the required shape of the output
+# ztgreen -- numpy.ndarray, Greenland temperature anomaly
+# The cubic is evaluated in Horner form in place in a single array, avoiding
+# the temporary arrays of the powers of ztgreen
+  smb=ztgreen*2.8
+  smb+=20.4
+  smb*=ztgreen
+  smb+=71.5
+  smb*=ztgreen
+  smb*=mSLEoGt
+  return smb
+
+def project_antsmb(zit,shape,rng,fraction=None):
+# Return projection of Antarctic SMB contribution as a numpy.ndarray
+# zit -- numpy.ndarray [climate_realization,time], ensemble of time-integral
+#   temperature anomaly timeseries
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 # fraction -- array-like, random numbers for the SMB-dynamic feedback
 
-  nr=template.axis('axiscomp').size
-  nt=template.axis('axisclim').size
-# antsmb=template.copy()
-# nr,nt,nyr=antsmb.shape
+  nr=shape.nm
+  nt=shape.nt
 
 # The following are [mean,SD]
   pcoK=[5.1,1.5] # % change in Ant SMB per K of warming from G&H06
   KoKg=[1.1,0.2] # ratio of Antarctic warming to global warming from G&H06
 
-# Generate a distribution of products of the above two factors
-  pcoKg=(pcoK[0]+numpy.random.standard_normal([nr,nt])*pcoK[1])*\
-    (KoKg[0]+numpy.random.standard_normal([nr,nt])*KoKg[1])
+# Generate a distribution of products of the above two factors, drawing the
+# normal random numbers for both at once
+  r=rng.standard_normal([2,nr,nt])
+  pcoKg=(pcoK[0]+r[0]*pcoK[1])*(KoKg[0]+r[1]*KoKg[1])
+  del(r)
   meansmb=1923 # model-mean time-mean 1979-2010 Gt yr-1 from 13.3.3.2
   moaoKg=-pcoKg*1e-2*meansmb*mSLEoGt # m yr-1 of SLE per K of global warming
 
   if fraction is None:
-    fraction=numpy.random.rand(nr,nt)
+    fraction=rng.random((nr,nt))
   elif fraction.size!=nr*nt:
     raise ProjectionError('fraction is the wrong size')
   else:
@@ -614,24 +797,17 @@ def project_antsmb(zit,template,fraction=None):
 
   smax=0.35 # max value of S in 13.SM.1.5
   ainterfactor=1-fraction*smax
-  
-# antsmb.data[:]=moaoKg*ainterfactor*zit.array.reshape(1,nt,-1)[:]
 
-  z=cf.Field()
-  z.set_construct(template.axis('axiscomp'),'axiscomp')
-  z.set_construct(template.dim('dimcomp'))
-  z.set_construct(template.axis('axisclim'),'axisclim')
-  z.set_construct(template.dim('dimclim'))
-  z.set_data(cf.Data(moaoKg*ainterfactor))
-  antsmb=z*zit
+  antsmb=(moaoKg*ainterfactor)[:,:,numpy.newaxis]*zit[numpy.newaxis,:,:]
 
   return antsmb
 
-def project_greendyn(scenario,template,palmer=False):
+def project_greendyn(scenario,shape,rng,palmer=False):
 # Return projection of Greenland rapid ice-sheet dynamics contribution
-# as a cf.Field
+# as a numpy.ndarray
 # scenario -- str, name of scenario
-# template -- cf.Field with the required shape of the output
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 
 # For SMB+dyn during 2005-2010 Table 4.6 gives 0.63+-0.17 mm yr-1 (5-95% range)
 # For dyn at 2100 Chapter 13 gives [20,85] mm for rcp85, [14,63] mm otherwise
@@ -641,13 +817,14 @@ def project_greendyn(scenario,template,palmer=False):
   else:
     finalrange=[0.014,0.063]
   return time_projection(0.63*fgreendyn,\
-    0.17*fgreendyn,finalrange,template,palmer=palmer)+fgreendyn*dgreen
+    0.17*fgreendyn,finalrange,shape,rng,palmer=palmer)+fgreendyn*dgreen
 
-def project_antdyn(template,fraction=None,levermann=None,output=None,
+def project_antdyn(shape,rng,fraction=None,levermann=None,output=None,
 palmer=False):
 # Return projection of Antarctic rapid ice-sheet dynamics contribution
-# as a cf.Field
-# template -- cf.Field with the required shape of the output
+# as a numpy.ndarray
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 # fraction -- array-like, random numbers for the dynamic contribution
 # levermann -- optional, str, use Levermann fit for specified scenario
 
@@ -661,86 +838,77 @@ palmer=False):
     print('using Levermann '+levermann+' for antdyn')
     lcoeff=lcoeff[levermann]
 
-    ascale=norm.ppf(fraction)
-    final=numpy.exp(lcoeff[2]*ascale**2+lcoeff[1]*ascale+lcoeff[0])
+# ndtri is the inverse of the standard normal cumulative distribution function,
+# the same as scipy.stats.norm.ppf but without its argument checking
+    ascale=ndtri(fraction)
+    final=numpy.exp((lcoeff[2]*ascale+lcoeff[1])*ascale+lcoeff[0])
 
   else: final=[-0.020,0.185]
 
 # For SMB+dyn during 2005-2010 Table 4.6 gives 0.41+-0.24 mm yr-1 (5-95% range)
 # For dyn at 2100 Chapter 13 gives [-20,185] mm for all scenarios
 
-  return time_projection(0.41,0.20,final,template,
+  return time_projection(0.41,0.20,final,shape,rng,
     palmer=palmer,fraction=fraction)+dant
 
-def project_landwater(template,palmer=False):
-# Return projection of land water storage contribution as a cf.Field
+def project_landwater(shape,rng,palmer=False):
+# Return projection of land water storage contribution as a numpy.ndarray
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 
 # The rate at start is the one for 1993-2010 from the budget table.
 # The final amount is the mean for 2081-2100.
   nyr=2100-2081+1 # number of years of the time-mean of the final amount
 
-  return time_projection(0.38,0.49-0.38,[-0.01,0.09],template,
+  return time_projection(0.38,0.49-0.38,[-0.01,0.09],shape,rng,
     nfinal=nyr,palmer=palmer)
 
-def time_projection(startratemean,startratepm,final,template,
+def time_projection(startratemean,startratepm,final,shape,rng,
   nfinal=1,fraction=None,palmer=False):
 # Return projection of a quantity which is a quadratic function of time
-# in a cf.Field.
+# as a numpy.ndarray [component_realization,climate_realization,time]
 # startratemean, startratepm -- rate of GMSLR at the start in mm yr-1, whose
 #   likely range is startratemean +- startratepm
 # final -- two-element list giving likely range in m for GMSLR at the endofAR5,
 #   or array-like, giving final values at that time, of the same shape as
 #   fraction and assumed corresponding elements
-# template -- cf.Field with the required shape of the output
+# shape -- Shape of the output
+# rng -- numpy.random.Generator, source of random numbers
 # nfinal -- int, optional, number of years at the end over which finalrange is
 #   a time-mean; by default 1 => finalrange is the value for the last year
 # fraction -- array-like, optional, random numbers in the range 0 to 1,
 #   by default uniformly distributed
 
-# Create a field of elapsed time since start in years
-  tdim=template.dim('T')
-  timedata=tdim.year.data
-  timeendofAR5=endofAR5-timedata[0].datum()+1
-  timedata=timedata-timedata[0]+1
-  time=cf.Field()
-  time.set_construct(template.axis('T'))
-  time.set_construct(tdim)
-  time.set_data(timedata)
-# nyr=template.axis('T').size # not correct if going beyond endofAR5
+# Elapsed time since start in years [time]
+  timedata=shape.year
+  timeendofAR5=endofAR5-timedata[0]+1
+  time=timedata-timedata[0]+1
+# nyr=shape.year.size # not correct if going beyond endofAR5
   nyr=timeendofAR5
 
-# more general than nr,nt,nyr=template.shape
-  nr=template.axis('axiscomp').size
-  nt=template.axis('axisclim').size
+  nr=shape.nm
+  nt=shape.nt
   if fraction is None:
-    fraction=numpy.random.rand(nr,nt)
+    fraction=rng.random((nr,nt))
   elif fraction.size!=nr*nt:
     raise ProjectionError('fraction is the wrong size')
-  data=cf.Data(fraction.reshape(nr,nt))
-
-  fraction=cf.Field()
-  fraction.set_construct(template.axis('axiscomp'),'axiscomp')
-  fraction.set_construct(template.dim('dimcomp'))
-  fraction.set_construct(template.axis('axisclim'),'axisclim')
-  fraction.set_construct(template.dim('dimclim'))
-  fraction.set_data(data)
 
 # Convert inputs to startrate (m yr-1) and afinal (m), where both are
-# arrays with the size of fraction
+# arrays [component_realization,climate_realization]
   momm=1e-3 # convert mm yr-1 to m yr-1
   startrate=(startratemean+\
-    startratepm*numpy.array([-1,1],dtype=float))*momm
+    startratepm*numpy.array([-1,1],dtype=numpy.float64))*momm
   finalisrange=isinstance(final,Sequence)
   if finalisrange:
     if len(final)!=2:
       raise ProjectionError('final range is the wrong size')
-#    afinal=numpy.array(final,dtype=float)  
+    fraction=fraction.reshape(nr,nt)
     afinal=(1-fraction)*final[0]+fraction*final[1]
   else:
     if final.shape!=fraction.shape:
       raise ProjectionError('final array is the wrong shape')
-    afinal=fraction.copy()
-    afinal.set_data(cf.Data(final))
+    fraction=fraction.reshape(nr,nt)
+    afinal=final.reshape(nr,nt)
   startrate=(1-fraction)*startrate[0]+fraction*startrate[1]
 
 # For terms where the rate increases linearly in time t, we can write GMSLR as
@@ -749,23 +917,24 @@ def time_projection(startratemean,startratepm,final,template,
 #   a = S/t**2-b/t = (S-b*t)/t**2
 # If nfinal=1, the following two lines are equivalent to
 # halfacc=(final-startyr*nyr)/nyr**2
-  finalyr = da.arange(nfinal) - nfinal + nyr + 1  # last element ==nyr
+  finalyr=numpy.arange(nfinal)-nfinal+nyr+1 # last element ==nyr
   halfacc=(afinal-startrate*finalyr.mean())/(finalyr**2).mean()
-  quadratic=halfacc*(time**2)
-  linear=startrate*time
 
 # If acceleration ceases for t>t0, the rate is 2*a*t0+b thereafter, so
 #   S(t) = a*t0**2 + b*t0 + (2*a*t0+b)*(t-t0)
 #        = a*t0*(2*t - t0) + b*t
 # i.e. the quadratic term is replaced, the linear term unaffected
 # The quadratic also = a*t**2-a*(t-t0)**2
+# Hence the time-dependence of the quadratic term is a timeseries [time] by
+# which a is multiplied in either case
 
   if palmer:
-    y=halfacc*timeendofAR5*(2*time-timeendofAR5)
-    y.persist(inplace=True)
-    quadratic.where(time<=timeendofAR5,y=y,inplace=True)
+    time2=numpy.where(time<=timeendofAR5,time**2,
+      timeendofAR5*(2*time-timeendofAR5))
+  else: time2=time**2
 
-  projection=quadratic+linear
-  projection.persist(inplace=True)
+# Broadcast [component_realization,climate_realization,1] against [time]
+  projection=halfacc[...,numpy.newaxis]*time2
+  projection+=startrate[...,numpy.newaxis]*time
 
   return projection